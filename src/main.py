@@ -1,78 +1,141 @@
 from aiohttp import web
 from aiohttp_cors import setup as cors_setup, ResourceOptions
 import asyncio
+import base64
+import concurrent.futures
 import json
 import logging
+import re
 import uuid
 from playwright.async_api import async_playwright
 from aiortc import RTCPeerConnection, RTCSessionDescription, MediaStreamTrack, VideoStreamTrack
 import av
-import fractions
-import numpy as np
-from PIL import Image
-import io
 import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Capture size, shared by the viewport and the screencast so frames never need resizing
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 720
+
+# Ad and tracker hosts to abort, matched against each request URL
+BLOCKED_URLS = re.compile(r'[/.](analytics|google-analytics|googletagmanager|ads|doubleclick)\.')
+
 class BrowserVideoStreamTrack(VideoStreamTrack):
-    def __init__(self, page):
+    def __init__(self, cdp):
         super().__init__()
-        self.page = page
-        self.start_time = time.time()
-        self.fps = 30
+        self.cdp = cdp
         self.frame_count = 0
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue(maxsize=2)
+        self.pending_acks = set()
+        self.decoder = av.CodecContext.create('mjpeg', 'r')
+        # Single worker: the decoder context must not be used from two threads at once
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.last_frame = None
+        self.frame_ready = asyncio.Event()
+        # Set while recv() has sent last_frame and wants a fresh one
+        self.frame_wanted = asyncio.Event()
+        self.frame_wanted.set()
+        self.decode_task = None
         logger.info("VideoStreamTrack initialized")
 
+    async def start_screencast(self):
+        # Let Chromium push JPEG frames instead of polling screenshots
+        self.cdp.on('Page.screencastFrame', self.on_screencast_frame)
+        await self.cdp.send('Page.startScreencast', {
+            'format': 'jpeg',
+            'quality': 60,
+            'maxWidth': FRAME_WIDTH,
+            'maxHeight': FRAME_HEIGHT,
+            'everyNthFrame': 1
+        })
+        self.decode_task = asyncio.ensure_future(self.decode_loop())
+        logger.info("Screencast started")
+
+    def on_screencast_frame(self, params):
+        # Frames are acked once consumed, so Chromium stops capturing while
+        # nobody needs a new frame. Drop (and ack) the oldest on overflow.
+        if self.frames.full():
+            _, dropped_id = self.frames.get_nowait()
+            self.ack_frame(dropped_id)
+        self.frames.put_nowait((params['data'], params['sessionId']))
+
+    def ack_frame(self, frame_id):
+        # Keep a reference to the ack task until it finishes
+        task = asyncio.ensure_future(self.send_ack(frame_id))
+        self.pending_acks.add(task)
+        task.add_done_callback(self.pending_acks.discard)
+
+    async def send_ack(self, frame_id):
+        try:
+            await self.cdp.send('Page.screencastFrameAck', {'sessionId': frame_id})
+        except Exception as e:
+            # The CDP session goes away with the page, late acks are expected to fail
+            logger.warning(f"Error acking screencast frame: {e}")
+
+    def decode_frame(self, data):
+        # Hand the JPEG bytes straight to libavcodec, no PIL/numpy round trip
+        packet = av.Packet(base64.b64decode(data))
+        frame = None
+        for frame in self.decoder.decode(packet):
+            pass
+        
+        # maxWidth/maxHeight are upper bounds, so Chromium may still send smaller frames
+        if frame is not None and (frame.width, frame.height) != (FRAME_WIDTH, FRAME_HEIGHT):
+            logger.warning(
+                f"Unexpected frame size {frame.width}x{frame.height}, "
+                f"expected {FRAME_WIDTH}x{FRAME_HEIGHT}"
+            )
+        
+        # The mjpeg decoder outputs yuvj420p, convert to the encoders' yuv420p once
+        # here instead of on every resend of an idle frame
+        if frame is not None:
+            frame = frame.reformat(format='yuv420p')
+        return frame
+
+    async def decode_loop(self):
+        # Decode the next frame while recv() waits for its send slot, but only
+        # once the previous one went out, so decode work is bounded by the send rate
+        while True:
+            await self.frame_wanted.wait()
+            data, frame_id = await self.frames.get()
+            self.ack_frame(frame_id)
+            # Skip straight to the newest pending frame
+            while not self.frames.empty():
+                data, frame_id = self.frames.get_nowait()
+                self.ack_frame(frame_id)
+            try:
+                # Decode off the event loop, libavcodec releases the GIL
+                decoded = await self.loop.run_in_executor(self.executor, self.decode_frame, data)
+            except Exception as e:
+                logger.error(f"Error decoding frame: {e}")
+                continue
+            if decoded is not None:
+                self.last_frame = decoded
+                self.frame_wanted.clear()
+                self.frame_ready.set()
+
     async def recv(self):
         try:
             # Increment frame count
             self.frame_count += 1
             
-            # Capture screenshot with specific dimensions
-            screenshot = await self.page.screenshot(
-                type='jpeg',
-                quality=80,
-                full_page=False,
-                clip={
-                    'x': 0,
-                    'y': 0,
-                    'width': 1280,
-                    'height': 720
-                }
-            )
-            
-            # Convert to PIL Image
-            image = Image.open(io.BytesIO(screenshot))
-            
-            # Ensure image is in RGB format and correct size
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            # Resize if needed
-            if image.size != (1280, 720):
-                image = image.resize((1280, 720), Image.Resampling.LANCZOS)
+            # Chromium only pushes frames when the page changes, so wait for
+            # the first one and afterwards repeat the last frame when idle
+            await self.frame_ready.wait()
             
-            # Convert to numpy array with correct shape
-            numpy_image = np.array(image)
+            # Let aiortc pace the track, it sleeps until the next 30 fps slot
+            pts, time_base = await self.next_timestamp()
             
-            # Create video frame with correct dimensions
-            frame = av.VideoFrame.from_ndarray(
-                numpy_image,
-                format='rgb24'
-            )
-            
-            # Set frame timing
-            pts = int((time.time() - self.start_time) * self.fps * 1000)
-            frame.time_base = fractions.Fraction(1, self.fps * 1000)
+            frame = self.last_frame
+            self.frame_wanted.set()
             frame.pts = pts
+            frame.time_base = time_base
             
             if self.frame_count % 30 == 0:  # Log every 30 frames
-                logger.info(f"Frame captured: {self.frame_count}, size: {numpy_image.shape}")
-            
-            # Small delay to maintain frame rate
-            await asyncio.sleep(1/self.fps)
+                logger.info(f"Frame captured: {self.frame_count}, size: {frame.width}x{frame.height}")
             
             return frame
             
@@ -83,14 +146,29 @@ class BrowserVideoStreamTrack(VideoStreamTrack):
 
     async def stop(self):
         logger.info("Stopping video track")
-        await super().stop()
+        try:
+            await self.cdp.send('Page.stopScreencast')
+        except Exception as e:
+            logger.warning(f"Error stopping screencast: {e}")
+        if self.decode_task:
+            self.decode_task.cancel()
+        self.executor.shutdown(wait=False)
+        super().stop()
+
+class ScrollState:
+    # Per-session scroll acceleration, slotted for cheap attribute access
+    __slots__ = ('speed', 'last_time', 'consecutive_scrolls')
+
+    def __init__(self, last_time):
+        self.speed = 1.0
+        self.last_time = last_time  # time.monotonic_ns()
+        self.consecutive_scrolls = 0
 
 class BrowserStreamer:
     def __init__(self):
         self.sessions = {}
         self.playwright = None
         self.browser = None
-        self.scroll_speeds = {}  # Store scroll speeds per session
         
     async def ensure_browser(self):
         try:
@@ -123,7 +201,7 @@ class BrowserStreamer:
             
             logger.info("Creating browser context")
             context = await browser.new_context(
-                viewport={'width': 1280, 'height': 720},
+                viewport={'width': FRAME_WIDTH, 'height': FRAME_HEIGHT},
                 device_scale_factor=1,
                 color_scheme='light',
                 user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -134,10 +212,13 @@ class BrowserStreamer:
             page = await context.new_page()
             
             # Set viewport size
-            await page.set_viewport_size({'width': 1280, 'height': 720})
+            await page.set_viewport_size({'width': FRAME_WIDTH, 'height': FRAME_HEIGHT})
+            
+            # One CDP session per page, shared by the video track and input events
+            cdp = await context.new_cdp_session(page)
             
             # Block ads and trackers
-            await page.route("**/(analytics|ads|google-analytics|doubleclick).*", lambda route: route.abort())
+            await page.route(BLOCKED_URLS, lambda route: route.abort())
             
             # Bypass reCAPTCHA
             await context.add_init_script("""
@@ -146,13 +227,34 @@ class BrowserStreamer:
                 });
             """)
             
+            # Scroll helper compiled once per document instead of per wheel event
+            await context.add_init_script("""
+                window.__scroll = (delta, smooth) => {
+                    const top = window.scrollY + delta;
+                    requestAnimationFrame(() => {
+                        window.scrollTo({
+                            top: top,
+                            behavior: smooth ? 'smooth' : 'auto'
+                        });
+                    });
+                    return top;
+                };
+            """)
+            
+            # Selection reader for clipboard copy, also compiled once per document
+            await context.add_init_script("""
+                window.__getSelection = () => window.getSelection()?.toString() || '';
+            """)
+            
             # Navigate to Google with specific parameters to avoid reCAPTCHA
             await page.goto('https://www.google.com/search?hl=en&gl=us&pws=0', 
                 wait_until='networkidle')
             
             return {
                 'context': context,
-                'page': page
+                'page': page,
+                'cdp': cdp,
+                'scroll': ScrollState(time.monotonic_ns())
             }
             
         except Exception as e:
@@ -172,13 +274,13 @@ class BrowserStreamer:
             )
             
             pc = RTCPeerConnection()
-            session_id = str(uuid.uuid4())
+            session_id = uuid.uuid4().hex
             logger.info(f"Created new session: {session_id}")
             
             @pc.on("connectionstatechange")
             async def on_connectionstatechange():
                 logger.info(f"Connection state changed to: {pc.connectionState}")
-                if pc.connectionState == "failed":
+                if pc.connectionState in ("failed", "closed"):
                     await pc.close()
                     if session_id in self.sessions:
                         await self.cleanup_session(session_id)
@@ -198,7 +300,9 @@ class BrowserStreamer:
                 }
                 
                 logger.info("Creating video track")
-                video_track = BrowserVideoStreamTrack(session['page'])
+                video_track = BrowserVideoStreamTrack(session['cdp'])
+                self.sessions[session_id]['track'] = video_track
+                await video_track.start_screencast()
                 pc.addTrack(video_track)
                 
                 logger.info("Setting WebRTC descriptions")
@@ -218,6 +322,7 @@ class BrowserStreamer:
             except Exception as e:
                 logger.error(f"Error in handle_offer: {e}")
                 logger.exception(e)
+                await self.cleanup_session(session_id)
                 raise
                 
         except Exception as e:
@@ -231,59 +336,43 @@ class BrowserStreamer:
     async def handle_event(self, request):
         try:
             data = await request.json()
-            session_id = data['session_id']
+            session = self.sessions.get(data['session_id'])
             
-            if session_id not in self.sessions:
+            if session is None:
                 return web.Response(status=404)
                 
-            session = self.sessions[session_id]
             page = session['page']
             
             if data['type'] == 'scroll':
                 try:
-                    # Get current scroll position
-                    current_scroll = await page.evaluate('window.scrollY')
-                    
-                    # Calculate new scroll position
+                    # Calculate scroll delta
                     delta = data['deltaY']
                     is_trackpad = data.get('isTrackpad', False)
                     
                     # Dynamic scroll speed adjustment
-                    if session_id not in self.scroll_speeds:
-                        self.scroll_speeds[session_id] = {
-                            'speed': 1.0,
-                            'last_time': time.time(),
-                            'consecutive_scrolls': 0
-                        }
-                    
-                    scroll_data = self.scroll_speeds[session_id]
-                    current_time = time.time()
-                    time_diff = current_time - scroll_data['last_time']
+                    scroll_state = session['scroll']
+                    current_time = time.monotonic_ns()
+                    time_diff = current_time - scroll_state.last_time
                     
                     # Adjust scroll speed based on scroll frequency
-                    if time_diff < 0.1:  # Rapid scrolling
-                        scroll_data['consecutive_scrolls'] += 1
-                        scroll_data['speed'] = min(2.5, scroll_data['speed'] * 1.1)
+                    if time_diff < 100_000_000:  # Rapid scrolling (< 100 ms)
+                        scroll_state.consecutive_scrolls += 1
+                        scroll_state.speed = min(2.5, scroll_state.speed * 1.1)
                     else:
-                        scroll_data['consecutive_scrolls'] = 0
-                        scroll_data['speed'] = 1.0
+                        scroll_state.consecutive_scrolls = 0
+                        scroll_state.speed = 1.0
                     
-                    scroll_data['last_time'] = current_time
+                    scroll_state.last_time = current_time
                     
                     # Calculate final scroll amount
                     base_speed = 2.0 if is_trackpad else 1.0
-                    scroll_amount = delta * base_speed * scroll_data['speed']
-                    new_scroll = current_scroll + scroll_amount
+                    scroll_amount = delta * base_speed * scroll_state.speed
                     
-                    # Use requestAnimationFrame for smoother scrolling
-                    await page.evaluate(f'''
-                        requestAnimationFrame(() => {{
-                            window.scrollTo({{
-                                top: {new_scroll},
-                                behavior: {'"smooth"' if is_trackpad else '"auto"'}
-                            }});
-                        }});
-                    ''')
+                    # Read scrollY and schedule the requestAnimationFrame scroll in one round trip
+                    await page.evaluate(
+                        '([delta, smooth]) => __scroll(delta, smooth)',
+                        [scroll_amount, is_trackpad]
+                    )
                     
                 except Exception as e:
                     logger.error(f"Scroll error: {e}")
@@ -297,19 +386,28 @@ class BrowserStreamer:
                     await page.go_forward()
             
             elif data['type'] == 'mouse':
-                await page.mouse.move(data['x'], data['y'])
+                # Dispatch straight over CDP, skipping Playwright's mouse wrapper
+                cdp = session['cdp']
+                await cdp.send('Input.dispatchMouseEvent', {
+                    'type': 'mouseMoved',
+                    'x': data['x'],
+                    'y': data['y']
+                })
                 if data.get('click'):
                     button = 'left'
                     if data.get('button') == 2:
                         button = 'right'
                     elif data.get('button') == 1:
                         button = 'middle'
-                    await page.mouse.click(
-                        data['x'], 
-                        data['y'], 
-                        button=button,
-                        click_count=data.get('clickCount', 1)
-                    )
+                    for click_count in range(1, data.get('clickCount', 1) + 1):
+                        for event_type in ('mousePressed', 'mouseReleased'):
+                            await cdp.send('Input.dispatchMouseEvent', {
+                                'type': event_type,
+                                'x': data['x'],
+                                'y': data['y'],
+                                'button': button,
+                                'clickCount': click_count
+                            })
             
             elif data['type'] == 'keyboard':
                 modifiers = []
@@ -321,23 +419,14 @@ class BrowserStreamer:
                     modifiers.append('Shift')
                 if data.get('meta'):
                     modifiers.append('Meta')
-                    
-                if modifiers:
-                    for modifier in modifiers:
-                        await page.keyboard.down(modifier)
-                        
-                await page.keyboard.press(data['key'])
                 
-                if modifiers:
-                    for modifier in modifiers:
-                        await page.keyboard.up(modifier)
+                # Send modifiers and key as a single chord, e.g. "Control+Shift+K"
+                await page.keyboard.press('+'.join(modifiers + [data['key']]))
             
             elif data['type'] == 'clipboard':
                 if data['action'] == 'copy':
                     # Get selected text from page
-                    text = await page.evaluate('''() => {
-                        return window.getSelection()?.toString() || '';
-                    }''')
+                    text = await page.evaluate('__getSelection()')
                     return web.json_response({'text': text})
                 
                 elif data['action'] == 'paste':
@@ -353,12 +442,15 @@ class BrowserStreamer:
             return web.json_response({'error': str(e)}, status=500)
    
     async def cleanup_session(self, session_id):
-        if session_id in self.sessions:
+        # Pop first so the "closed" state change from pc.close() doesn't clean up twice
+        session = self.sessions.pop(session_id, None)
+        if session:
             try:
-                session = self.sessions[session_id]
+                # aiortc never stops local tracks, so end the screencast and decode loop here
+                if 'track' in session:
+                    await session['track'].stop()
                 await session['context'].close()
                 await session['pc'].close()
-                del self.sessions[session_id]
                 logger.info(f"Cleaned up session: {session_id}")
             except Exception as e:
                 logger.error(f"Error cleaning up session: {e}")